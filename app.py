@@ -1,95 +1,297 @@
 import streamlit as st
 import requests
-import boto3
-import gspread
-from google.oauth2.service_account import Credentials
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+import hashlib
+import io
+import json
+import os
+import threading
 import time
+import diskcache
 
-# Function to initialize Google Sheets client
+# boto3, botocore, gspread and google-auth are imported lazily inside the functions that use them,
+# so the Streamlit UI starts without parsing their (large) module trees until the first run.
+
+# Number of rows synthesized and uploaded concurrently; tune against Azure's 429 responses
+# with the optional "tts_max_workers" AWS secret, capped at the HTTP connection pool size
+MAX_WORKERS = 8
+MAX_WORKERS_LIMIT = 32
+
+# Azure TTS request budget per minute; the old fixed pacing (3 requests per 20 seconds) is the
+# default, raise it to the deployment's quota with the optional "tts_requests_per_minute" AWS secret.
+# At the default, calls are ~6.7 s apart, so extra workers add no throughput until it is raised.
+# Retries after a 429 or 5xx are re-sent by the session's Retry and do not go through the limiter.
+TTS_REQUESTS_PER_MINUTE = 9
+
+# On-disk cache of S3 URLs keyed by (bucket, request hash), so reruns skip TTS entirely
+URL_CACHE_DIR = os.path.expanduser("~/.cache/tts_audio")
+
+# Size above which an upload is treated as large and sent as a threaded multipart transfer
+LARGE_UPLOAD_THRESHOLD = 32 * 1024 * 1024
+
+# Static part of the TTS request body; only "input" varies per row
+_TTS_PAYLOAD = {
+    "model": "tts-1",
+    "voice": "echo",
+    "output_format": "audio-24khz-48kbitrate-mp3"
+}
+
+# Shared HTTP session so Azure TTS connections are kept alive and reused across rows and threads.
+# Throttling (429) and transient 5xx responses are retried with exponential backoff,
+# waiting for the Retry-After header when Azure sends one.
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=MAX_WORKERS_LIMIT,
+    pool_maxsize=MAX_WORKERS_LIMIT,
+    max_retries=Retry(
+        total=8,
+        backoff_factor=1.0,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["POST"],
+        respect_retry_after_header=True
+    )
+))
+
+# Function to initialize Google Sheets client (cached across Streamlit reruns)
+@st.cache_resource
 def init_google_sheets_client():
+    import gspread
+    from google.oauth2.service_account import Credentials
+
     scopes = ["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive"]
     credentials = Credentials.from_service_account_info(st.secrets["gcp_service_account"], scopes=scopes)
     return gspread.authorize(credentials)
 
-# Initialize S3 client with region
+# Initialize S3 client with region (cached across Streamlit reruns).
+# Set use_accelerate_endpoint in the AWS secrets to upload through S3 Transfer Acceleration
+# when the app does not run in the bucket's region (the bucket must have acceleration enabled).
+@st.cache_resource
 def init_s3_client():
+    import boto3
+    from botocore.config import Config
+
+    config = Config(
+        signature_version="s3v4",
+        # Only a real TOML boolean enables it; a string such as "false" must not turn it on
+        s3={"use_accelerate_endpoint": st.secrets["AWS"].get("use_accelerate_endpoint") is True},
+        tcp_keepalive=True,
+        max_pool_connections=MAX_WORKERS_LIMIT,  # At least one socket per worker thread
+        connect_timeout=3,
+        read_timeout=60,
+        retries={"max_attempts": 5, "mode": "adaptive"}
+    )
     return boto3.client(
         's3',
         aws_access_key_id=st.secrets["AWS"]["aws_access_key_id"],
         aws_secret_access_key=st.secrets["AWS"]["aws_secret_access_key"],
-        region_name=st.secrets["AWS"]["aws_region"]
+        region_name=st.secrets["AWS"]["aws_region"],
+        config=config
     )
 
-# Convert column letter to index (e.g., A -> 1, B -> 2)
-def column_letter_to_index(letter):
-    return ord(letter.upper()) - ord('A') + 1
+# Open a spreadsheet by ID, caching the Drive metadata lookup per spreadsheet
+@st.cache_resource
+def open_spreadsheet(spreadsheet_id):
+    return init_google_sheets_client().open_by_key(spreadsheet_id)
+
+# Thread-safe limiter that spaces calls evenly so at most `per_minute` start in any minute
+class RateLimiter:
+    def __init__(self, per_minute):
+        self.interval = 60.0 / per_minute
+        self.lock = threading.Lock()
+        self.next_slot = time.monotonic()
+
+    # Block the calling thread until its slot comes up
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        time.sleep(slot - now)
+
+# Shared limiter for Azure TTS calls, so the budget holds across reruns and sessions
+@st.cache_resource
+def get_tts_rate_limiter(per_minute):
+    return RateLimiter(per_minute)
+
+# Open the on-disk URL cache (shared across Streamlit reruns and sessions)
+@st.cache_resource
+def get_url_cache():
+    return diskcache.Cache(URL_CACHE_DIR)
+
+# S3 transfer settings: TTS clips are tiny, so skip multipart and thread setup for them,
+# and only fan out parts for the occasional response above the threshold
+@lru_cache(maxsize=None)
+def get_transfer_config(large):
+    from boto3.s3.transfer import TransferConfig
+
+    if large:
+        return TransferConfig(
+            multipart_threshold=8 * 1024 * 1024,
+            multipart_chunksize=8 * 1024 * 1024,
+            max_concurrency=4,
+            use_threads=True
+        )
+    return TransferConfig(multipart_threshold=LARGE_UPLOAD_THRESHOLD, use_threads=False, max_concurrency=1)
+
+# Request headers for Azure TTS; the key is read on every call so a rotated secret is picked up
+def get_tts_headers():
+    return {"Content-Type": "application/json", "api-key": st.secrets["AWS"]["azure_api_key"]}
+
+# Build the UTF-8 encoded JSON request body for Azure TTS
+def tts_request_body(text):
+    return json.dumps({**_TTS_PAYLOAD, "input": text}).encode("utf-8")
+
+# Build the public URL of an object in the bucket
+def s3_object_url(bucket_name, file_name):
+    return f"https://{bucket_name}.s3.{st.secrets['AWS']['aws_region']}.amazonaws.com/{file_name}"
 
-# Generate TTS and upload to S3 with rate-limiting
-def generate_and_upload_tts(text, s3_client, bucket_name, file_name):
+# Check whether an object already exists in the bucket. Without s3:GetObject (or s3:ListBucket for
+# missing keys) S3 answers 403; that is treated as "not known to exist" so only s3:PutObject is required.
+def s3_object_exists(s3_client, bucket_name, file_name):
+    from botocore.exceptions import ClientError
+
+    try:
+        s3_client.head_object(Bucket=bucket_name, Key=file_name)
+        return True
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey", "403", "AccessDenied", "Forbidden"):
+            return False
+        raise
+
+# Generate TTS from a prebuilt request body and upload to S3
+# (runs in worker threads, so failures are raised, not shown)
+def generate_and_upload_tts(body, s3_client, bucket_name, file_name, rate_limiter):
+    # Object names are content-addressed, so an existing object already holds this request's audio
+    if s3_object_exists(s3_client, bucket_name, file_name):
+        return s3_object_url(bucket_name, file_name)
+
+    rate_limiter.wait()
     API_URL = st.secrets["AWS"]["azure_tts_api_url"]
-    API_KEY = st.secrets["AWS"]["azure_api_key"]
-    headers = {"Content-Type": "application/json", "api-key": API_KEY}
-    payload = {
-        "model": "tts-1",
-        "input": text,
-        "voice": "echo",
-        "output_format": "audio-24khz-48kbitrate-mp3"
-    }
-
-    response = requests.post(API_URL, headers=headers, json=payload)
-
-    if response.status_code == 200:
-        # Upload to S3
-        s3_client.put_object(Bucket=bucket_name, Key=file_name, Body=response.content)
-        return f"https://{bucket_name}.s3.{st.secrets['AWS']['aws_region']}.amazonaws.com/{file_name}"
-    else:
-        st.error(f"Failed with status code {response.status_code}: {response.text}")
-        return None
+    headers = get_tts_headers()
+
+    # Copy the audio into a buffer this function owns and close the response right away, so the
+    # Azure connection goes back to the pool during the S3 upload and boto3 can rewind on retries
+    with _SESSION.post(API_URL, headers=headers, data=body, timeout=(3, 60)) as response:
+        if response.status_code != 200:
+            raise RuntimeError(f"Failed with status code {response.status_code}: {response.text}")
+        audio = io.BytesIO(response.content)
+    del response  # The buffer is the only reference to the audio from here on
+
+    # Upload to S3
+    transfer_config = get_transfer_config(audio.getbuffer().nbytes > LARGE_UPLOAD_THRESHOLD)
+    s3_client.upload_fileobj(audio, bucket_name, file_name, Config=transfer_config)
+
+    return s3_object_url(bucket_name, file_name)
 
 # Process Google Sheet and update with S3 URLs
 def process_google_sheet(spreadsheet_id, source_column_letter, target_column_letter):
-    google_sheets_client = init_google_sheets_client()
     s3_client = init_s3_client()
     bucket_name = st.secrets["AWS"]["s3_bucket_name"]
-    
-    # Convert column letters to indices
-    source_column = column_letter_to_index(source_column_letter)
-    target_column = column_letter_to_index(target_column_letter)
+    max_workers = max(1, min(int(st.secrets["AWS"].get("tts_max_workers", MAX_WORKERS)), MAX_WORKERS_LIMIT))
+    requests_per_minute = max(1, int(st.secrets["AWS"].get("tts_requests_per_minute", TTS_REQUESTS_PER_MINUTE)))
+    rate_limiter = get_tts_rate_limiter(requests_per_minute)
+    if "tts_requests_per_minute" not in st.secrets["AWS"]:
+        st.info(
+            f"Azure TTS calls are paced at the default {TTS_REQUESTS_PER_MINUTE} requests per minute, so rows "
+            "are effectively processed one at a time. Set tts_requests_per_minute in the AWS secrets to your "
+            "deployment's quota to let the parallel workers speed up processing."
+        )
     
     # Access the Google Sheet
-    sheet = google_sheets_client.open_by_key(spreadsheet_id).sheet1  # Assumes the first sheet
-    texts = sheet.col_values(source_column)
-    
-    request_count = 0  # Track the number of requests within a minute
+    sheet = open_spreadsheet(spreadsheet_id).sheet1  # Assumes the first sheet
+
+    # Read source and target columns (header row skipped) in one request so filled rows can be skipped.
+    # Values are formatted as displayed, so TTS reads dates, percentages and currency as the user sees them.
+    source_values, target_values = (
+        value_range[0] if value_range else []
+        for value_range in sheet.batch_get(
+            [f"{source_column_letter}2:{source_column_letter}", f"{target_column_letter}2:{target_column_letter}"],
+            major_dimension="COLUMNS"
+        )
+    )
 
     with st.spinner("Processing rows..."):
         processed_any = False  # Track if any rows were processed
-        for row_num, text in enumerate(texts[1:], start=2):  # Skip header row
-            if text:
-                text = str(text)  # Ensure text is a string
-                file_name = f"tts_audio_row{row_num}.mp3"
-                
-                # Generate TTS audio and upload to S3
-                s3_url = generate_and_upload_tts(text, s3_client, bucket_name, file_name)
-                
-                # Check if S3 URL is returned successfully
-                if s3_url:
-                    try:
-                        # Update Google Sheet with the S3 URL
-                        sheet.update_cell(row_num, target_column, s3_url)
-                        processed_any = True
-                        st.success(f"Processed row {row_num}: {s3_url}")
-                    except Exception as e:
-                        st.error(f"Failed to update row {row_num} in Google Sheet: {e}")
-                
-                # Increment request count and apply rate-limiting
-                request_count += 1
-                if request_count % 3 == 0:  # After every 3 requests
-                    st.info("Rate limit reached. Pausing for 20 seconds...")
-                    time.sleep(20)  # Wait to comply with rate limits
-            else:
-                st.warning(f"Skipping empty cell at row {row_num}.")
-        
+
+        # Rows with source text and no URL yet; rows filled on a previous run are left as-is
+        jobs = [
+            (row_num, str(text))
+            for row_num, text in enumerate(source_values, start=2)
+            if text != "" and not (row_num - 2 < len(target_values) and target_values[row_num - 2])
+        ]
+
+        # Group rows by SHA1 of their full TTS request (text plus model, voice and format), so each
+        # unique text is synthesized once and a payload change never reuses audio from the old one
+        # The body is serialized once here and handed to the worker as-is.
+        bodies_by_key = {}  # SHA1 of request -> request body
+        rows_by_key = {}  # SHA1 of request -> rows sharing that text
+        for row_num, text in jobs:
+            body = tts_request_body(text)
+            key = hashlib.sha1(body).hexdigest()
+            bodies_by_key.setdefault(key, body)
+            rows_by_key.setdefault(key, []).append(row_num)
+
+        # Texts synthesized on an earlier run are served from the on-disk cache
+        url_cache = get_url_cache()
+        cache: dict[str, str] = {}  # SHA1 of request -> S3 URL
+        for key in list(bodies_by_key):
+            cached_url = url_cache.get((bucket_name, key))
+            if cached_url:
+                cache[key] = cached_url
+                del bodies_by_key[key]
+
+        # Only the TTS + S3 work runs in the pool; the gspread client is not thread-safe
+        progress = st.progress(0.0)
+        # Streamlit stops a run (Stop button, widget change) by raising in this thread at the next st.*
+        # call; queued rows are then cancelled instead of being synthesized and uploaded for nothing
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        try:
+            # Content-addressed object names, so identical texts share one object
+            futures = {
+                executor.submit(
+                    generate_and_upload_tts, body, s3_client, bucket_name, f"tts_{key}.mp3", rate_limiter
+                ): key
+                for key, body in bodies_by_key.items()
+            }
+            for done, future in enumerate(as_completed(futures), start=1):
+                key = futures[future]
+                try:
+                    cache[key] = url_cache[(bucket_name, key)] = future.result()
+                except Exception as e:
+                    failed_rows = ", ".join(str(r) for r in rows_by_key[key])
+                    st.error(f"Failed to generate audio for row(s) {failed_rows}: {e}")
+                progress.progress(done / len(futures))
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        # Duplicate rows reuse the URL of their first occurrence
+        results = [(row_num, cache[key]) for key, rows in rows_by_key.items() if key in cache for row_num in rows]
+
+        # Update Google Sheet with all S3 URLs in a single batch request on the main thread. Each run of
+        # consecutive rows is written as one range, and no cell outside the results is rewritten.
+        if results:
+            results.sort()
+            runs = []  # [first row, [[url], ...]] per run of consecutive rows
+            for row_num, s3_url in results:
+                if runs and row_num == runs[-1][0] + len(runs[-1][1]):
+                    runs[-1][1].append([s3_url])
+                else:
+                    runs.append([row_num, [[s3_url]]])
+            updates = [
+                {"range": f"{target_column_letter}{start}:{target_column_letter}{start + len(values) - 1}", "values": values}
+                for start, values in runs
+            ]
+            try:
+                sheet.batch_update(updates, value_input_option="RAW")
+                processed_any = True
+                for row_num, s3_url in results:
+                    st.success(f"Processed row {row_num}: {s3_url}")
+            except Exception as e:
+                st.error(f"Failed to update Google Sheet: {e}")
+
         if not processed_any:
             st.warning("No valid rows found to process.")
 